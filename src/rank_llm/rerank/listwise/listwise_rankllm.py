@@ -5,7 +5,7 @@ import random
 import re
 from abc import ABC
 from datetime import datetime
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from ftfy import fix_text
 from tqdm import tqdm
@@ -544,11 +544,13 @@ class ListwiseRankLLM(RankLLM, ABC):
             def execute(
                 batch: List[Union[str, Dict[str, str]]],
                 selected_indices_batch: List[List[int]],
+                top_k: Optional[int] = None,
             ):
                 return [
                     self._permutation_to_rank(s, selected_indices)
                     for (s, _), selected_indices in zip(
-                        self.run_llm_batched(batch, **kwargs), selected_indices_batch
+                        self.run_llm_batched(batch, top_k=top_k, **kwargs),
+                        selected_indices_batch,
                     )
                 ]
 
@@ -563,10 +565,11 @@ class ListwiseRankLLM(RankLLM, ABC):
             def execute(
                 batch: List[Union[str, Dict[str, str]]],
                 selected_indices_batch: List[List[int]],
+                top_k: Optional[int] = None,
             ):
                 return [
                     self._permutation_to_rank(
-                        self.run_llm(x, **kwargs)[0], selected_indices
+                        self.run_llm(x, top_k=top_k, **kwargs)[0], selected_indices
                     )
                     for x, selected_indices in zip(batch, selected_indices_batch)
                 ]
@@ -1,7 +1,9 @@
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import torch
-from transformers import T5Tokenizer
+from torch.nn.utils.rnn import pad_sequence
+from transformers import T5TokenizerFast
+from transformers.modeling_outputs import BaseModelOutput
 
 from rank_llm.data import Request, Result
 from rank_llm.rerank.listwise.listwise_rankllm import ListwiseRankLLM
@@ -10,6 +12,47 @@ from rank_llm.rerank.listwise.reorder.reorder_policy import ReorderPolicy
 from rank_llm.rerank.rankllm import PromptMode
 
 
+def _run_by_passage_count(
+    batch_prompts: List[List[Any]],
+    run: Callable[..., List[Tuple[str, int]]],
+    **kwargs,
+) -> List[Tuple[str, int]]:
+    """
+    FiD needs a fixed number of passages per generate() call. Group the prompts by their number
+    of passages, run every group at once, then scatter the outputs back into the original order.
+    """
+    groups: Dict[int, List[int]] = {}
+    for i, prompts in enumerate(batch_prompts):
+        groups.setdefault(len(prompts), []).append(i)
+
+    outputs: List[Tuple[str, int]] = [None] * len(batch_prompts)
+    for idxes in groups.values():
+        for i, output in zip(idxes, run([batch_prompts[i] for i in idxes], **kwargs)):
+            outputs[i] = output
+
+    return outputs
+
+
+def _batch_input_ids(
+    tokenizer, batch_ids: List[Tuple[int, ...]], max_length: int
+) -> Dict[str, torch.Tensor]:
+    """
+    Same as calling the tokenizer on the prompts with truncation to max_length and padding to the
+    longest one, but starts from input ids that are already encoded.
+    """
+    truncated = []
+    for ids in batch_ids:
+        ids = list(ids)
+        if len(ids) > max_length:
+            # keep the eos token at the end, like the tokenizer truncation does
+            ids = ids[: max_length - 1] + ids[-1:]
+        truncated.append(ids)
+
+    return tokenizer.pad(
+        {"input_ids": truncated}, padding="longest", return_tensors="pt"
+    )
+
+
 class RankFiDDistill(ListwiseRankLLM):
     def _post_init(self):
         self._to_precision(self._precision)
@@ -39,6 +82,7 @@ class RankFiDDistill(ListwiseRankLLM):
         precision: str = "bfloat16",
         device: str = "cuda",
         batched: bool = False,
+        encoder_cache_size: int = 0,
     ) -> None:
         """
         Creates instance of the RankFiDDistill class, a specialized version of RankLLM designed from Lit5-Distill.
@@ -52,7 +96,7 @@ class RankFiDDistill(ListwiseRankLLM):
             num_few_shot_examples=num_few_shot_examples,
         )
         self._precision = precision
-        self._tokenizer = T5Tokenizer.from_pretrained(model)
+        self._tokenizer = T5TokenizerFast.from_pretrained(model)
         self._llm = FiD.from_pretrained(model).to(device).eval()
 
         self._device = device
@@ -68,10 +112,90 @@ class RankFiDDistill(ListwiseRankLLM):
             )
         )
 
-        self._output_token_estimate = None
+        # windows could be smaller (the tail of a sliding window) or larger than the window size
+        self._output_token_estimate_by_window: Dict[int, int] = {
+            w: self._estimate_output_tokens(w)
+            for w in range(1, 2 * self._window_size + 1)
+        }
+
+        # prompts are revisited by many windows, memoize their input ids. create_prompt counts
+        #   tokens with them and the model run reuses them instead of tokenizing again. a round
+        #   creates the prompts of every request before running any, so the memo is not bounded,
+        #   it is cleared at the end of rerank_batch
+        self._input_ids_cache: Dict[str, Tuple[int, ...]] = {}
+
+        # FiD encodes each passage independently, so the encoder states of a passage can be reused
+        #   when the same prompt shows up again in another window. keyed by the unpadded input ids.
+        #   the prompt embeds the window position, so hits are rare and the cache is off by default
+        self._enc_cache: Dict[Tuple[int, ...], torch.Tensor] = {}
+        self._enc_cache_size = encoder_cache_size
+
+        # a candidate lands in many windows / tournament pops of its query, convert its doc once.
+        #   keyed by id(doc). rerank_batch copies the candidates of every request, the cached doc is
+        #   kept with its content so that a later copy can not reuse its id
+        self._passage_content_cache: Dict[int, Tuple[Dict[str, Any], str]] = {}
 
         self._post_init()
 
+    def _encode_passages(
+        self, input_ids: torch.Tensor, attention_mask: torch.Tensor, batch_size: int
+    ) -> BaseModelOutput:
+        """
+        Encode the passages (batch_size * n_passages, seq_len) missing in the encoder cache, and
+        gather the encoder states of all passages into FiD layout (batch_size, n_passages * seq_len, d_model).
+        Only used when the encoder cache is enabled, the input tensors are already on the device.
+        """
+        lengths = attention_mask.sum(dim=-1).tolist()
+        keys = [tuple(ids[:n]) for ids, n in zip(input_ids.tolist(), lengths)]
+
+        hidden_of: Dict[Tuple[int, ...], torch.Tensor] = {}
+        missing: Dict[Tuple[int, ...], int] = {}
+        for i, key in enumerate(keys):
+            if key in self._enc_cache:
+                hidden_of[key] = self._enc_cache[key]
+            elif key not in missing:
+                missing[key] = i
+
+        if len(missing) > 0:
+            idxes = list(missing.values())
+            hidden_states = self._llm.encoder(
+                input_ids=input_ids[idxes],
+                attention_mask=attention_mask[idxes],
+                n_passages=1,
+                return_dict=True,
+            ).last_hidden_state
+            for j, i in enumerate(idxes):
+                hidden_of[keys[i]] = hidden_states[j, : lengths[i]]
+                # drop the oldest entry when the cache is full. cache a copy, a view would keep
+                #   the whole padded batch alive
+                if self._enc_cache_size > 0:
+                    if len(self._enc_cache) >= self._enc_cache_size:
+                        del self._enc_cache[next(iter(self._enc_cache))]
+                    self._enc_cache[keys[i]] = hidden_of[keys[i]].clone()
+
+        # zero pad every passage back to the padded input length
+        states = pad_sequence([hidden_of[key] for key in keys], batch_first=True)
+        if states.shape[1] < input_ids.shape[1]:
+            states = torch.nn.functional.pad(
+                states, (0, 0, 0, input_ids.shape[1] - states.shape[1])
+            )
+
+        d_model = states.shape[-1]
+        return BaseModelOutput(last_hidden_state=states.view(batch_size, -1, d_model))
+
+    def _input_ids_of(self, text: str) -> Tuple[int, ...]:
+        ids = self._input_ids_cache.get(text)
+        if ids is None:
+            ids = self._input_ids_cache[text] = tuple(self._tokenizer.encode(text))
+        return ids
+
+    def _passage_content(self, doc: Dict[str, Any], max_length: int) -> str:
+        cached = self._passage_content_cache.get(id(doc))
+        if cached is None or cached[0] is not doc:
+            cached = (doc, self.convert_doc_to_prompt_content(doc, max_length))
+            self._passage_content_cache[id(doc)] = cached
+        return cached[1]
+
     def _run_llm_by_length_unified(
         self, batch_prompts: List[List[str]]
     ) -> List[Tuple[str, int]]:
@@ -80,22 +204,28 @@ class RankFiDDistill(ListwiseRankLLM):
 
         self._llm.eval()
 
+        tokenizer = self._tokenizer
+        input_ids_of = self._input_ids_of
+        device = self._device
+
         batch_size = len(batch_prompts)
         n_passages = len(batch_prompts[0])
 
+        tokenized = _batch_input_ids(
+            tokenizer,
+            [input_ids_of(prompt) for prompts in batch_prompts for prompt in prompts],
+            self.max_tokens(),
+        )
+
+        tokenized = {k: v.to(device) for k, v in tokenized.items()}
         # single batch, unsqueeze
-        inputs = {
-            k: v.reshape(batch_size, -1).to(self._device)
-            for k, v in self._tokenizer(
-                [prompt for prompts in batch_prompts for prompt in prompts],
-                return_tensors="pt",
-                padding="max_length",
-                truncation=True,
-                max_length=self.max_tokens(),
-            ).items()
-        }
+        inputs = {k: v.reshape(batch_size, -1) for k, v in tokenized.items()}
 
-        with torch.no_grad():
+        with torch.inference_mode():
+            if self._enc_cache_size > 0:
+                inputs["encoder_outputs"] = self._encode_passages(
+                    tokenized["input_ids"], tokenized["attention_mask"], batch_size
+                )
             outputs = self._llm.generate(
                 **inputs,
                 max_length=self._answer_maxlength,
@@ -104,7 +234,7 @@ class RankFiDDistill(ListwiseRankLLM):
             )
 
         decoded_outputs = [
-            self._tokenizer.decode(outputs[i], skip_special_tokens=True)
+            tokenizer.decode(outputs[i], skip_special_tokens=True)
             for i in range(outputs.shape[0])
         ]
 
@@ -122,15 +252,20 @@ class RankFiDDistill(ListwiseRankLLM):
         logging: bool = False,
         **kwargs: Any,
     ) -> List[Result]:
-        return super().rerank_batch(
-            requests=requests,
-            rank_start=rank_start,
-            rank_end=rank_end,
-            shuffle_candidates=shuffle_candidates,
-            logging=logging,
-            batched=self._batched,
-            **kwargs,
-        )
+        try:
+            return super().rerank_batch(
+                requests=requests,
+                rank_start=rank_start,
+                rank_end=rank_end,
+                shuffle_candidates=shuffle_candidates,
+                logging=logging,
+                batched=self._batched,
+                **kwargs,
+            )
+        finally:
+            self._enc_cache.clear()
+            self._passage_content_cache.clear()
+            self._input_ids_cache.clear()
 
     def run_llm_batched(
         self, prompts: List[List[Dict[str, str]]], **kwargs
@@ -138,12 +273,12 @@ class RankFiDDistill(ListwiseRankLLM):
         if len(prompts) == 0:
             return []
 
-        # unfortunately, we are not allowed to use VLLM on T5. However, we could unify the prompts by passage size
-        #   (which is commonly the same) then rerank stuff having same passage sizes
+        # unfortunately, we are not allowed to use VLLM on T5. However, we unify the prompts by passage size
+        #   (which is commonly the same) then rerank stuff having same passage sizes together
 
         prompt_infos = [list(map(lambda x: x["text"], prompt)) for prompt in prompts]
 
-        return self._run_llm_by_length_unified(prompt_infos)
+        return _run_by_passage_count(prompt_infos, self._run_llm_by_length_unified)
 
     def create_prompt_batched(
         self, results: List[Result], selected_indices_batch: List[int], batch_size: int
@@ -169,30 +304,33 @@ class RankFiDDistill(ListwiseRankLLM):
         Create a prompt based on the result and given ranking range.
         """
 
+        prefix = self._gen_passage_prefix(result.query.text)
+        max_tokens = self.max_tokens()
+        gen_passage = self._gen_passage
+        convert = self._passage_content
+        candidates = result.candidates
+
         # For now, we concat the prompt, because it seems LiT5 is also concatting the stuff
         prompts = [
             {
-                "text": self._gen_passage(
-                    result.query.text,
-                    loc + 1,
-                    self.convert_doc_to_prompt_content(
-                        result.candidates[idx].doc, self.max_tokens()
-                    ),
+                "text": gen_passage(
+                    prefix, loc + 1, convert(candidates[idx].doc, max_tokens)
                 )
             }
             for loc, idx in enumerate(selected_indices)
         ]
 
-        return prompts, sum(self.get_num_tokens(prompt["text"]) for prompt in prompts)
+        get_num_tokens = self.get_num_tokens
+        return prompts, sum(get_num_tokens(prompt["text"]) for prompt in prompts)
 
     def get_num_tokens(self, prompt: Union[str, List[Dict[str, str]]]) -> int:
         """
         Abstract method to calculate the number of tokens contained in the given prompt.
         """
         if isinstance(prompt, str):
-            return len(self._tokenizer.encode(prompt))
+            return len(self._input_ids_of(prompt))
         elif isinstance(prompt, list):
-            return sum(len(self._tokenizer.encode(item["text"])) for item in prompt)
+            return sum(len(self._input_ids_of(item["text"])) for item in prompt)
         else:
             raise ValueError(
                 "Prompt must be a string or a list of dictionaries with a 'text' key."
@@ -201,34 +339,32 @@ class RankFiDDistill(ListwiseRankLLM):
     def cost_per_1k_token(self, input_token: bool) -> float:
         return 0
 
+    def _estimate_output_tokens(self, window_size: int) -> int:
+        return (
+            len(
+                self._tokenizer.encode(
+                    " > ".join([f"[{i + 1}]" for i in range(window_size)])
+                )
+            )
+            - 1
+        )
+
     def num_output_tokens(self, current_window_size: Optional[int] = None) -> int:
         if current_window_size is None:
             current_window_size = self._window_size
-        if (
-            self._output_token_estimate is not None
-            and self._window_size == current_window_size
-        ):
-            return self._output_token_estimate
-        else:
-            output_token_estimate = (
-                len(
-                    self._tokenizer.encode(
-                        " > ".join([f"[{i + 1}]" for i in range(current_window_size)])
-                    )
-                )
-                - 1
-            )
-            if (
-                self._output_token_estimate is None
-                and self._window_size == current_window_size
-            ):
-                self._output_token_estimate = output_token_estimate
+        if current_window_size not in self._output_token_estimate_by_window:
+            self._output_token_estimate_by_window[
+                current_window_size
+            ] = self._estimate_output_tokens(current_window_size)
+        return self._output_token_estimate_by_window[current_window_size]
 
-            return output_token_estimate
+    @staticmethod
+    def _gen_passage_prefix(query: str) -> str:
+        return f"Search Query: {query} Passage: "
 
     @staticmethod
-    def _gen_passage(query: str, index: int, passage: str) -> str:
-        return f"Search Query: {query} Passage: [{index}] {passage} Relevance Ranking: "
+    def _gen_passage(prefix: str, index: int, passage: str) -> str:
+        return prefix + f"[{index}] {passage} Relevance Ranking: "
 
 
 class RankFiDScore(ListwiseRankLLM):
@@ -244,13 +380,21 @@ class RankFiDScore(ListwiseRankLLM):
         """
         We don't support python12 for now, after python 12, the code should be changed into
         """
-        if precision == "float32":
+        if precision in ("float32", "bfloat16_autocast"):
             self._llm = self._llm.float()
         elif precision == "bfloat16":
             self._llm = self._llm.bfloat16()
         elif precision == "float16":
             self._llm = self._llm.float16()
 
+    def _autocast(self):
+        # "bfloat16_autocast" keeps the float32 weights and runs the matmuls in bfloat16
+        return torch.autocast(
+            device_type=torch.device(self._device).type,
+            dtype=torch.bfloat16,
+            enabled=self._precision == "bfloat16_autocast",
+        )
+
     def __init__(
         self,
         reorder_policy: ReorderPolicy,
@@ -272,43 +416,84 @@ class RankFiDScore(ListwiseRankLLM):
             num_few_shot_examples=num_few_shot_examples,
         )
         self._precision = precision
-        self._tokenizer = T5Tokenizer.from_pretrained(model)
+        self._tokenizer = T5TokenizerFast.from_pretrained(model)
         self._llm = FiDCrossAttentionScore.from_pretrained(model).to(device).eval()
 
         self._device = device
 
         self._batched = batched
 
-        self._output_token_estimate = None
+        # windows could be smaller (the tail of a sliding window) or larger than the window size
+        self._output_token_estimate_by_window: Dict[int, int] = {
+            w: self._estimate_output_tokens(w)
+            for w in range(1, 2 * self._window_size + 1)
+        }
+
+        # prompts are revisited by many windows, memoize their input ids. create_prompt counts
+        #   tokens with them and the model run reuses them instead of tokenizing again. a round
+        #   creates the prompts of every request before running any, so the memo is not bounded,
+        #   it is cleared at the end of rerank_batch
+        self._input_ids_cache: Dict[str, Tuple[int, ...]] = {}
+
+        # the same batch of queries recurs on every window / tournament pop
+        self._query_mask_cache: Dict[Tuple[str, ...], torch.Tensor] = {}
+
+        # a candidate lands in many windows / tournament pops of its query, convert its doc once.
+        #   keyed by id(doc). rerank_batch copies the candidates of every request, the cached doc is
+        #   kept with its content so that a later copy can not reuse its id
+        self._passage_content_cache: Dict[int, Tuple[Dict[str, Any], str]] = {}
 
         self._post_init()
 
+    def _input_ids_of(self, text: str) -> Tuple[int, ...]:
+        ids = self._input_ids_cache.get(text)
+        if ids is None:
+            ids = self._input_ids_cache[text] = tuple(self._tokenizer.encode(text))
+        return ids
+
+    def _passage_content(self, doc: Dict[str, Any], max_length: int) -> str:
+        cached = self._passage_content_cache.get(id(doc))
+        if cached is None or cached[0] is not doc:
+            cached = (doc, self.convert_doc_to_prompt_content(doc, max_length))
+            self._passage_content_cache[id(doc)] = cached
+        return cached[1]
+
     def _run_llm_by_length_unified(
-        self, batch_prompts: List[List[Tuple[str, str]]]
+        self, batch_prompts: List[List[Tuple[str, str]]], top_k: Optional[int] = None
     ) -> List[Tuple[str, int]]:
+        """
+        With top_k, only the top_k passages of each prompt are ranked in the output.
+        """
         if len(batch_prompts) == 0:
             return []
 
+        tokenizer = self._tokenizer
+        input_ids_of = self._input_ids_of
+        device = self._device
+        max_tokens = self.max_tokens()
+
         # get arbitrary query (they should be the same)
         queries = [prompts[0][0] for prompts in batch_prompts]
         batch_size = len(batch_prompts)
         n_passages = len(batch_prompts[0])
 
         inputs = {
-            k: v.reshape(batch_size, -1).to(self._device)
-            for k, v in self._tokenizer(
-                [prompt for prompts in batch_prompts for (_, prompt) in prompts],
-                return_tensors="pt",
-                padding="max_length",
-                truncation=True,
-                max_length=self.max_tokens(),
+            k: v.reshape(batch_size, -1).to(device)
+            for k, v in _batch_input_ids(
+                tokenizer,
+                [
+                    input_ids_of(prompt)
+                    for prompts in batch_prompts
+                    for (_, prompt) in prompts
+                ],
+                max_tokens,
             ).items()
         }
 
         passage_ids = inputs["input_ids"]
-        passage_mask = inputs["attention_mask"]
+        passage_mask = inputs["attention_mask"].bool()
 
-        with torch.no_grad():
+        with torch.inference_mode(), self._autocast():
             self._llm.reset_score_storage()
 
             outputs = self._llm.generate(
@@ -327,26 +512,38 @@ class RankFiDScore(ListwiseRankLLM):
                 output_length = outputs.shape[1]
             output_sequence_lengths.append(output_length)
 
-        query_mask_reader = self._tokenizer(
-            queries,
-            max_length=self.max_tokens(),
-            padding="longest",
-            truncation=True,
-            return_tensors="pt",
-            add_special_tokens=False,
-        )["attention_mask"].bool()
+        query_key = tuple(queries)
+        if query_key not in self._query_mask_cache:
+            self._query_mask_cache[query_key] = (
+                tokenizer(
+                    queries,
+                    max_length=max_tokens,
+                    padding="longest",
+                    truncation=True,
+                    return_tensors="pt",
+                    add_special_tokens=False,
+                )["attention_mask"]
+                .bool()
+                .to(device)
+            )
+        query_mask_reader = self._query_mask_cache[query_key]
 
-        with torch.no_grad():
+        with torch.inference_mode(), self._autocast():
             crossattention_scores = self._llm.get_crossattention_scores(
                 n_passages,
-                ids=passage_ids.to(self._device),
-                mask=passage_mask.bool().to(self._device),
-                mask_query=query_mask_reader.to(self._device),
+                ids=passage_ids,
+                mask=passage_mask,
+                mask_query=query_mask_reader,
                 output_sequence_lengths=output_sequence_lengths,
             )
             # only supports normswoquery for now
             crossattention_score: torch.Tensor = crossattention_scores["normswoquery"]
-            sorted, idxes = torch.sort(crossattention_score, dim=-1, descending=True)
+            if top_k is not None and top_k < crossattention_score.shape[1]:
+                _, idxes = torch.topk(
+                    crossattention_score, k=top_k, dim=-1, largest=True, sorted=True
+                )
+            else:
+                idxes = torch.argsort(crossattention_score, dim=-1, descending=True)
             idxes = idxes.detach().cpu()
 
         return [
@@ -366,15 +563,20 @@ class RankFiDScore(ListwiseRankLLM):
         logging: bool = False,
         **kwargs: Any,
     ) -> List[Result]:
-        return super().rerank_batch(
-            requests=requests,
-            rank_start=rank_start,
-            rank_end=rank_end,
-            shuffle_candidates=shuffle_candidates,
-            logging=logging,
-            batched=self._batched,
-            **kwargs,
-        )
+        try:
+            return super().rerank_batch(
+                requests=requests,
+                rank_start=rank_start,
+                rank_end=rank_end,
+                shuffle_candidates=shuffle_candidates,
+                logging=logging,
+                batched=self._batched,
+                **kwargs,
+            )
+        finally:
+            self._query_mask_cache.clear()
+            self._passage_content_cache.clear()
+            self._input_ids_cache.clear()
 
     def run_llm_batched(
         self, prompts: List[List[Dict[str, str]]], **kwargs
@@ -382,14 +584,18 @@ class RankFiDScore(ListwiseRankLLM):
         if len(prompts) == 0:
             return []
 
-        # unfortunately, we are not allowed to use VLLM on T5. However, we could unify the prompts by passage size
-        #   (which is commonly the same) then rerank stuff having same passage sizes
+        # unfortunately, we are not allowed to use VLLM on T5. However, we unify the prompts by passage size
+        #   (which is commonly the same) then rerank stuff having same passage sizes together
 
         processed_prompts = [
             [(x["query"], x["text"]) for x in prmpt] for prmpt in prompts
         ]
 
-        return self._run_llm_by_length_unified(processed_prompts)
+        return _run_by_passage_count(
+            processed_prompts,
+            self._run_llm_by_length_unified,
+            top_k=kwargs.get("top_k"),
+        )
 
     def create_prompt_batched(
         self,
@@ -405,7 +611,7 @@ class RankFiDScore(ListwiseRankLLM):
     def run_llm(self, prompts: List[Dict[str, str]], **kwargs) -> Tuple[str, int]:
         # get arbitrary query (they should be the same)
         return self._run_llm_by_length_unified(
-            [[(x["query"], x["text"]) for x in prompts]]
+            [[(x["query"], x["text"]) for x in prompts]], top_k=kwargs.get("top_k")
         )[0]
 
     def create_prompt(
@@ -415,6 +621,13 @@ class RankFiDScore(ListwiseRankLLM):
         Create a prompt based on the result and given ranking range.
         """
         query = result.query.text
+        query_text = f"question: {query}"
+        prefix = self._gen_passage_prefix(query)
+        max_tokens = self.max_tokens()
+        gen_passage = self._gen_passage
+        convert = self._passage_content
+        get_num_tokens = self.get_num_tokens
+        candidates = result.candidates
         results = []
 
         sum_token = 0
@@ -422,50 +635,43 @@ class RankFiDScore(ListwiseRankLLM):
         for i in selected_indices:
             results.append(
                 {
-                    "query": f"question: {query}",
-                    "text": self._gen_passage(
-                        query,
-                        self.convert_doc_to_prompt_content(
-                            result.candidates[i].doc, self.max_tokens()
-                        ),
-                    ),
+                    "query": query_text,
+                    "text": gen_passage(prefix, convert(candidates[i].doc, max_tokens)),
                 }
             )
-            sum_token += len(self._tokenizer.encode(results[-1]["text"]))
+            sum_token += get_num_tokens(results[-1]["text"])
 
         return results, sum_token
 
     def get_num_tokens(self, prompt: str) -> int:
-        return len(self._tokenizer.encode(prompt))
+        return len(self._input_ids_of(prompt))
 
     def cost_per_1k_token(self, input_token: bool) -> float:
         return 0.0
 
+    def _estimate_output_tokens(self, window_size: int) -> int:
+        return (
+            len(
+                self._tokenizer.encode(
+                    " > ".join([f"[{i + 1}]" for i in range(window_size)])
+                )
+            )
+            - 1
+        )
+
     def num_output_tokens(self, current_window_size: Optional[int] = None) -> int:
         if current_window_size is None:
             current_window_size = self._window_size
-        if (
-            self._output_token_estimate is not None
-            and self._window_size == current_window_size
-        ):
-            return self._output_token_estimate
-        else:
-            output_token_estimate = (
-                len(
-                    self._tokenizer.encode(
-                        " > ".join([f"[{i + 1}]" for i in range(current_window_size)])
-                    )
-                )
-                - 1
-            )
-            if (
-                self._output_token_estimate is None
-                and self._window_size == current_window_size
-            ):
-                self._output_token_estimate = output_token_estimate
+        if current_window_size not in self._output_token_estimate_by_window:
+            self._output_token_estimate_by_window[
+                current_window_size
+            ] = self._estimate_output_tokens(current_window_size)
+        return self._output_token_estimate_by_window[current_window_size]
 
-            return output_token_estimate
+    @staticmethod
+    def _gen_passage_prefix(query: str) -> str:
+        return f"question: {query} context: "
 
     @staticmethod
-    def _gen_passage(query: str, passage: str) -> str:
-        return f"question: {query} context: {passage}"
+    def _gen_passage(prefix: str, passage: str) -> str:
+        return prefix + passage
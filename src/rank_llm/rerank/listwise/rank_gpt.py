@@ -160,6 +160,7 @@ class SafeOpenai(ListwiseRankLLM):
         self,
         prompt: Union[str, List[Dict[str, str]]],
         current_window_size: Optional[int] = None,
+        **kwargs,
     ) -> Tuple[str, int]:
         model_key = "model"
         response = self._call_completion(
@@ -134,6 +134,7 @@ class RankListwiseOSLLM(ListwiseRankLLM):
         self,
         prompts: List[str | List[Dict[str, str]]],
         current_window_size: Optional[int] = None,
+        **kwargs,
     ) -> List[Tuple[str, int]]:
         if SamplingParams is None:
             raise ImportError(
@@ -152,7 +153,7 @@ class RankListwiseOSLLM(ListwiseRankLLM):
         ]
 
     def run_llm(
-        self, prompt: str, current_window_size: Optional[int] = None
+        self, prompt: str, current_window_size: Optional[int] = None, **kwargs
     ) -> Tuple[str, int]:
         if current_window_size is None:
             current_window_size = self._window_size
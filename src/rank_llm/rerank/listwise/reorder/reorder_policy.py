@@ -15,10 +15,9 @@ class ModelFunction:
         [List[Tuple[Result, List[int]]]], List[Union[str, Dict[str, str]]]
     ]
 
-    # [Prompt], [SelectedIndices] -> [Permutation]
-    execute: Callable[
-        [List[Union[str, Dict[str, str]]], List[List[int]]], List[List[int]]
-    ]
+    # [Prompt], [SelectedIndices], top_k=None -> [Permutation]
+    #   with top_k, only the first top_k positions of each permutation have to be ranked
+    execute: Callable[..., List[List[int]]]
 
     # Accepted Window Size
     window_size: int
@@ -1,6 +1,7 @@
 import copy
 from dataclasses import dataclass
-from typing import Callable, Dict, List, Tuple, Union
+from itertools import islice
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
 
 from rank_llm.data import Result
 
@@ -11,6 +12,15 @@ from .reorder_policy import ModelFunction, ReorderPolicy
 class ResortRequest:
     indices: List[int]
     result: List[int]
+    # only the first top_k positions of the result are used, None for the full permutation
+    top_k: Optional[int] = None
+
+
+@dataclass
+class BatchResortRequest:
+    indices: List[List[int]]
+    results: List[List[int]]
+    top_k: Optional[int] = None
 
 
 class TournamentSortNode:
@@ -68,16 +78,54 @@ class TournamentSortNode:
             self._children = children
             self._top: List[int] = None
             self._tmp: List[int] = None
+            # loser tree record: `_top` keeps the order of the last resort, so `_top[1:]` are the
+            #   losers of the current champion and could be replayed after a pop. `_compared` are
+            #   the candidates of the last resort, the ones missing in `_top` lost to all of `_top`
+            self._compared: Set[int] = set()
+            self._dirty = False
+            # set by a pop: the child on the popped path, and `_top` without the popped index
+            self._changed: "TournamentSortNode" = None
+            self._losers: List[int] = None
         else:
             self._n = -1
             self._index = index
             self._top: List[int] = [index]
             self._tmp: List[int] = None
 
-    def reset(self):
-        if self._n == -1:
+    def reset(self, changed: "TournamentSortNode" = None, popped: int = None):
+        if self._n == -1 or self._top is None:
             return
+        self._dirty = True
+        self._changed = changed
+        self._losers = [x for x in self._top if x != popped]
+
+    def can_compact(self) -> bool:
+        """
+        After a pop only the child on the popped path could bring new candidates. With enough
+        stored losers, they only need to be ranked against the losers instead of all children.
+        """
+        return (
+            self._n != -1
+            and self._dirty
+            and self._changed is not None
+            and len(self._losers) >= self._top_k
+        )
+
+    def compact_resort_param(self) -> Union[List[int], None]:
+        assert self.can_compact()
+
+        challengers = [x for x in self._changed.top() if x not in self._compared]
+        self._changed = None
+
+        if len(challengers) == 0:
+            self._top = self._losers
+            self._losers = None
+            self._dirty = False
+            return None
+
+        self._tmp = challengers + self._losers[: self._top_k]
         self._top = None
+        return [ind for ind in self._tmp]
 
     def invalidate(self):
         if self._n != -1:
@@ -86,26 +134,75 @@ class TournamentSortNode:
         self._top = []
 
     def get_resort_param(self) -> Union[List[int], None]:
-        if self._n == -1 or self._top is not None:
+        if self._n == -1 or (self._top is not None and not self._dirty):
             return None
-        self._tmp = [x for child in self._children for x in child.top()]
+
+        self._changed, self._losers = None, None
+
+        candidates = [x for child in self._children for x in child.top()]
+
+        if self._top is not None:
+            alive = set(candidates)
+            losers = [x for x in self._top if x in alive]
+            # no new candidate came up from the children, the stored losers are still in order
+            if all(x in self._compared for x in candidates) and len(losers) >= min(
+                self._top_k, len(candidates)
+            ):
+                self._top = losers
+                self._dirty = False
+                return None
+
+        # nothing to compare, no need to ask the model
+        if len(candidates) <= 1:
+            self._top = list(candidates)
+            self._compared = set(candidates)
+            self._dirty = False
+            return None
+
+        self._tmp = candidates
+        self._top = None
         return [ind for ind in self._tmp]
 
     def resort(self, perm: List[int]):
+        """
+        perm could be a prefix of the permutation, the candidates not in it are ranked below.
+        """
         assert self._tmp is not None and self._top is None
 
-        tops = []
-        for i in perm:
-            if len(tops) > self._top_k:
-                break
-            ind = self._tmp[i]
-            if ind not in tops:
+        if len(perm) == 1:
+            tops = [self._tmp[perm[0]]]
+        else:
+            tops = []
+            seen = set()
+            for i in perm:
+                ind = self._tmp[i]
+                if ind in seen:
+                    continue
+                seen.add(ind)
                 tops.append(ind)
 
+        if self._losers is not None:
+            # compact resort: the ranking is only known down to the last replayed loser. if all
+            #   challengers beat it, the losers not replayed still follow in order
+            replayed = self._losers[: self._top_k]
+            pos = {ind: i for i, ind in enumerate(tops)}
+            if all(x in pos for x in replayed):
+                tops = tops[: max(pos[x] for x in replayed) + 1]
+                if len(tops) == len(self._tmp):
+                    tops = tops + self._losers[self._top_k :]
+            self._compared.update(self._tmp)
+            self._losers = None
+        else:
+            self._compared = set(self._tmp)
+
         self._top = tops
+        self._dirty = False
 
         return
 
+    def children(self) -> List["TournamentSortNode"]:
+        return self._children if self._n != -1 else []
+
     def top(self) -> List[int]:
         assert self._top is not None
         return self._top[: min(len(self._top), self._top_k)]
@@ -118,32 +215,24 @@ class TournamentSortNode:
 
 
 class TournamentSorter:
-    def _get_random_indices(
-        self, expect_size: int, ind_choices: List[int]
-    ) -> List[int]:
-        choices = set(ind_choices)
-        result = []
-        for j in reversed(range(self._n_passage)):
-            if len(result) + len(ind_choices) >= expect_size:
-                break
-            if j not in choices:
-                result.append(j)
-
-        for j in reversed(range(self._n_passage)):
-            if len(result) + len(ind_choices) >= expect_size:
-                break
-            result.append(j)
-        return result
-
     def _pad_size(self, inds: List[int]) -> List[int]:
-        if len(inds) >= self._window_size:
+        need = self._window_size - len(inds)
+        if need <= 0:
             return inds
-        else:
-            fitters = self._get_random_indices(self._window_size, inds)
-            return inds + fitters
+
+        chosen = set(inds)
+        padded = inds + list(
+            islice((j for j in self._fill_order if j not in chosen), need)
+        )
+
+        # not enough passages to fill up the window, repeat them
+        padded.extend(islice(self._fill_order, self._window_size - len(padded)))
+
+        return padded
 
     def _unpad_perm(self, inds: List[int], padded: List[int], perm: List[int]):
-        return [x for x in perm if x < len(inds)]
+        n = len(inds)
+        return [x for x in perm if x < n]
 
     def _fill_up(self, result: List[int]) -> List[int]:
         result_set = set(result)
@@ -162,6 +251,9 @@ class TournamentSorter:
 
         self._indices = indices
 
+        # padding is taken from the tail of the list
+        self._fill_order = list(reversed(range(self._n_passage)))
+
         self._tr, self._all_node, self._idx_to_node = TournamentSortNode.build(
             indices, window_size=window_size, top_k=r
         )
@@ -169,39 +261,82 @@ class TournamentSorter:
     def _pop(self, x: int) -> List[TournamentSortNode]:
         on: TournamentSortNode = self._idx_to_node[x]
         lst = []
+        changed: TournamentSortNode = None
         while on is not None:
             lst.append(on)
             on.invalidate()
-            on.reset()
+            on.reset(changed=changed, popped=x)
+            changed = on
             on = on.parent
         return lst
 
+    def _request_top_k(self, inds: List[int], padded: List[int], n_pop: int) -> int:
+        # a node is popped at most n_pop more times and still needs its r tops after that.
+        #   padded candidates might take some of the top positions
+        return min(len(padded), n_pop + self._r + len(padded) - len(inds))
+
+    def _batch_resort(self, nodes: List[TournamentSortNode], n_pop: int):
+        params = []
+        for nd in nodes:
+            resort_param = nd.get_resort_param()
+            if resort_param is not None:
+                params.append((nd, resort_param, self._pad_size(resort_param)))
+
+        if len(params) == 0:
+            return
+
+        request = BatchResortRequest(
+            [padded for _, _, padded in params],
+            [],
+            max(
+                self._request_top_k(resort_param, padded, n_pop)
+                for _, resort_param, padded in params
+            ),
+        )
+        yield request
+        assert len(request.results) == len(params)
+
+        for (nd, resort_param, padded), perm in zip(params, request.results):
+            nd.resort(self._unpad_perm(resort_param, padded, perm[: request.top_k]))
+
     def perform(self, top_k: int):
         result = []
 
-        # firstly, simple sort
+        # firstly, simple sort. nodes whose children are all sorted are independent, so they
+        #   are sent as one batch
+        batch: List[TournamentSortNode] = []
+        batch_set = set()
         for nd in self._all_node:
-            resort_param = nd.get_resort_param()
-            if resort_param is not None:
-                padded = self._pad_size(resort_param)
-                request = ResortRequest(padded, [])
-                yield request
-                cleaned_result = self._unpad_perm(resort_param, padded, request.result)
-                nd.resort(cleaned_result)
+            if any(child in batch_set for child in nd.children()):
+                yield from self._batch_resort(batch, top_k)
+                batch, batch_set = [], set()
+            batch.append(nd)
+            batch_set.add(nd)
+        yield from self._batch_resort(batch, top_k)
 
         while len(result) < top_k:
             tpv = self._tr.top()[0]
             result.append(tpv)
             nodes = self._pop(tpv)
             for node in nodes:
-                resort_param = node.get_resort_param()
+                if node.can_compact():
+                    # new candidates against the stored losers only, no padding to the window
+                    resort_param = node.compact_resort_param()
+                    padded = resort_param
+                else:
+                    resort_param = node.get_resort_param()
+                    if resort_param is not None:
+                        padded = self._pad_size(resort_param)
                 if resort_param is not None:
-                    padded = self._pad_size(resort_param)
-                    request = ResortRequest(padded, [])
+                    request = ResortRequest(
+                        padded,
+                        [],
+                        self._request_top_k(resort_param, padded, top_k - len(result)),
+                    )
                     yield request
                     assert len(request.result) > 0
                     cleaned_result = self._unpad_perm(
-                        resort_param, padded, request.result
+                        resort_param, padded, request.result[: request.top_k]
                     )
                     node.resort(cleaned_result)
 
@@ -211,7 +346,7 @@ class TournamentSorter:
 def multiple_sort(
     requests: List[Result],
     indices_batch: List[List[int]],
-    runner: Callable[[List[Tuple[Result, List[int]]]], List[List[int]]],
+    runner: Callable[[List[Tuple[Result, List[int]]], Optional[int]], List[List[int]]],
     window_size: int,
     r: int,
     top_k: int,
@@ -240,10 +375,32 @@ def multiple_sort(
         for idx in finish_requests:
             left_not_sorted.remove(idx)
 
-        outputs = runner([(requests[idx], req.indices) for idx, req in perm_request])
+        flattened = [
+            (idx, indices)
+            for idx, req in perm_request
+            for indices in (
+                req.indices if isinstance(req, BatchResortRequest) else [req.indices]
+            )
+        ]
+
+        # the model ranks the positions needed by every request in this round
+        top_ks = [req.top_k for _, req in perm_request]
+        runner_top_k = (
+            None if len(top_ks) == 0 or any(k is None for k in top_ks) else max(top_ks)
+        )
+
+        outputs = runner(
+            [(requests[idx], indices) for idx, indices in flattened], runner_top_k
+        )
 
-        for (idx, req), output in zip(perm_request, outputs):
-            req.result = output
+        on = 0
+        for idx, req in perm_request:
+            if isinstance(req, BatchResortRequest):
+                req.results = outputs[on : on + len(req.indices)]
+                on += len(req.indices)
+            else:
+                req.result = outputs[on]
+                on += 1
 
     return result
 
@@ -264,9 +421,9 @@ class TournamentSortReorderPolicy(ReorderPolicy):
         window_size = model.window_size
 
         runner: Callable[
-            [List[Tuple[Result, List[int]]]], List[List[int]]
-        ] = lambda reqs: model.execute(
-            model.create_prompt(reqs), [ind for req, ind in reqs]
+            [List[Tuple[Result, List[int]]], Optional[int]], List[List[int]]
+        ] = lambda reqs, top_k: model.execute(
+            model.create_prompt(reqs), [ind for req, ind in reqs], top_k=top_k
         )
 
         request_ranks = multiple_sort(
@@ -301,6 +301,7 @@ class Reranker:
                 ("device", "cuda"),
                 # reuse this parameter, but its not for "vllm", but only for "batched"
                 ("vllm_batched", False),
+                ("encoder_cache_size", 0),
             ]
 
             (
@@ -311,6 +312,7 @@ class Reranker:
                 precision,
                 device,
                 vllm_batched,
+                encoder_cache_size,
             ) = extract_kwargs(keys_and_defaults, **kwargs)
 
             agent = RankFiDDistill(
@@ -323,6 +325,7 @@ class Reranker:
                 precision=precision,
                 device=device,
                 batched=vllm_batched,
+                encoder_cache_size=encoder_cache_size,
             )
             print(f"Completed loading {model_path}")
         elif "lit5-score" in model_path.lower():
@@ -0,0 +1,354 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, processors
+from transformers import PreTrainedTokenizerFast, T5Config
+
+from rank_llm.data import Candidate, Query, Result
+from rank_llm.rerank.listwise.lit5.model import FiD
+from rank_llm.rerank.listwise.rank_fid import (
+    RankFiDDistill,
+    RankFiDScore,
+    _batch_input_ids,
+    _run_by_passage_count,
+)
+
+# fmt: off
+VOCAB = [
+    "<pad>", "</s>", "<unk>", "question", "context", ":", "q", "Search", "Query",
+    "Passage", "Relevance", "Ranking", "[", "]", ">",
+] + [str(i) for i in range(10)] + [f"p{i}" for i in range(10)]
+# fmt: on
+
+
+def make_tokenizer() -> PreTrainedTokenizerFast:
+    # small word level stand-in for the T5 tokenizer: appends </s>, pads with <pad>
+    tokenizer = Tokenizer(
+        models.WordLevel({w: i for i, w in enumerate(VOCAB)}, unk_token="<unk>")
+    )
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="$A </s>", special_tokens=[("</s>", 1)]
+    )
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        pad_token="<pad>",
+        eos_token="</s>",
+        unk_token="<unk>",
+    )
+
+
+def matmul_dtype() -> torch.dtype:
+    return (torch.ones(2, 2) @ torch.ones(2, 2)).dtype
+
+
+class TestRunByPassageCount(unittest.TestCase):
+    def test_outputs_in_input_order(self):
+        # tournament sort mixes short replays with full windows in one batch
+        batch_prompts = [
+            [f"q{i}_p{j}" for j in range(n)] for i, n in enumerate([20, 2, 20, 3, 2])
+        ]
+        calls = []
+
+        def run(prompts, top_k=None):
+            calls.append([len(p) for p in prompts])
+            self.assertEqual(len(set(len(p) for p in prompts)), 1)
+            return [(p[0].split("_")[0], top_k) for p in prompts]
+
+        outputs = _run_by_passage_count(batch_prompts, run, top_k=5)
+        self.assertEqual(outputs, [(f"q{i}", 5) for i in range(5)])
+        self.assertEqual(sorted(calls), [[2, 2], [3], [20, 20]])
+        self.assertEqual(_run_by_passage_count([], run), [])
+
+
+class TestBatchInputIds(unittest.TestCase):
+    def test_same_as_tokenizer(self):
+        tokenizer = make_tokenizer()
+        max_length = 6
+        texts = [
+            "question : q",
+            "question : q context : p1 p2",
+            # longer than max_length, truncated with the eos kept
+            "question : q context : p1 p2 p3 p4 p5",
+        ]
+        expected = tokenizer(
+            texts,
+            padding="longest",
+            truncation=True,
+            max_length=max_length,
+            return_tensors="pt",
+        )
+        batch = _batch_input_ids(
+            tokenizer, [tuple(tokenizer.encode(text)) for text in texts], max_length
+        )
+        self.assertEqual(batch["input_ids"].shape, (3, max_length))
+        self.assertTrue(torch.equal(batch["input_ids"], expected["input_ids"]))
+        self.assertTrue(
+            torch.equal(batch["attention_mask"], expected["attention_mask"])
+        )
+
+
+class TestRankFiDScore(unittest.TestCase):
+    def setUp(self):
+        self.scores = torch.tensor([[0.1, 0.9, 0.5]])
+        self.dtypes = []
+
+        def generate(input_ids, attention_mask, n_passages, **kwargs):
+            self.assertEqual(input_ids.shape[0], 1)
+            self.assertEqual(n_passages, 3)
+            self.dtypes.append(matmul_dtype())
+            return torch.tensor([[0, 5, 6, 1, 0]])
+
+        def get_crossattention_scores(n_passages, output_sequence_lengths, **kwargs):
+            self.assertEqual(output_sequence_lengths, [3])
+            self.dtypes.append(matmul_dtype())
+            return {"normswoquery": self.scores}
+
+        self.mock_llm = MagicMock()
+        for method in ("to", "eval", "float", "bfloat16", "float16"):
+            getattr(self.mock_llm, method).return_value = self.mock_llm
+        self.mock_llm.generate.side_effect = generate
+        self.mock_llm.get_crossattention_scores.side_effect = get_crossattention_scores
+
+        self.patcher_tokenizer = patch(
+            "rank_llm.rerank.listwise.rank_fid.T5TokenizerFast.from_pretrained",
+            return_value=make_tokenizer(),
+        )
+        self.patcher_llm = patch(
+            "rank_llm.rerank.listwise.rank_fid.FiDCrossAttentionScore.from_pretrained",
+            return_value=self.mock_llm,
+        )
+        self.patcher_tokenizer.start()
+        self.patcher_llm.start()
+
+    def tearDown(self):
+        self.patcher_tokenizer.stop()
+        self.patcher_llm.stop()
+
+    def _model(self, precision: str) -> RankFiDScore:
+        return RankFiDScore(
+            reorder_policy=MagicMock(),
+            model="castorini/LiT5-Score-base",
+            precision=precision,
+            device="cpu",
+        )
+
+    def _prompts(self):
+        return [
+            {"query": "question: q", "text": f"question: q context: p{i}"}
+            for i in range(3)
+        ]
+
+    def test_run_llm(self):
+        model = self._model("float32")
+        self.assertEqual(model.run_llm(self._prompts()), ("[2] > [3] > [1]", 6))
+        self.assertEqual(model.run_llm(self._prompts(), top_k=1), ("[2]", 6))
+        self.assertEqual(self.dtypes, [torch.float32] * 4)
+
+    def test_run_llm_batched(self):
+        model = self._model("bfloat16")
+        self.assertEqual(
+            model.run_llm_batched([self._prompts()], top_k=2), [("[2] > [3]", 6)]
+        )
+
+    def test_bfloat16_autocast(self):
+        model = self._model("bfloat16_autocast")
+        self.mock_llm.float.assert_called()
+        self.mock_llm.bfloat16.assert_not_called()
+        self.assertEqual(model.run_llm(self._prompts())[0], "[2] > [3] > [1]")
+        self.assertEqual(self.dtypes, [torch.bfloat16] * 2)
+
+    def test_passage_content_not_shared_across_requests(self):
+        # rerank_batch works on fresh candidate copies for every request and drops them after,
+        #   so doc addresses get reused by the next request
+        model = self._model("float32")
+        for qid in range(3):
+            result = Result(
+                query=Query(text="q", qid=qid),
+                candidates=[
+                    Candidate(docid=i, score=0.0, doc={"text": f"d{qid}_{i}"})
+                    for i in range(100)
+                ],
+            )
+            prompts, _ = model.create_prompt(result, list(range(100)))
+            self.assertEqual(
+                [prompt["text"] for prompt in prompts],
+                [f"question: q context: d{qid}_{i}" for i in range(100)],
+            )
+            del result, prompts
+
+    def test_input_ids_kept_for_the_round(self):
+        # a round creates the prompts of every request (queries x candidates) before running
+        #   any of them, the model run must still find their ids
+        model = self._model("float32")
+        result = Result(
+            query=Query(text="q", qid=0),
+            candidates=[
+                Candidate(docid=i, score=0.0, doc={"text": f"p{i % 10} {i}"})
+                for i in range(5000)
+            ],
+        )
+        prompts, _ = model.create_prompt(result, list(range(5000)))
+        with patch.object(
+            model._tokenizer, "encode", wraps=model._tokenizer.encode
+        ) as encode:
+            for prompt in prompts:
+                model._input_ids_of(prompt["text"])
+        encode.assert_not_called()
+
+        with patch(
+            "rank_llm.rerank.listwise.rank_fid.ListwiseRankLLM.rerank_batch",
+            return_value=[],
+        ):
+            model.rerank_batch([])
+        self.assertEqual(len(model._input_ids_cache), 0)
+
+
+class TestRankFiDDistill(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.llm = FiD(
+            T5Config(
+                vocab_size=len(VOCAB),
+                d_model=16,
+                d_kv=4,
+                d_ff=32,
+                num_layers=2,
+                num_heads=4,
+                decoder_start_token_id=0,
+                pad_token_id=0,
+                eos_token_id=1,
+            )
+        ).eval()
+        self.tokenizer = make_tokenizer()
+
+        self.patcher_tokenizer = patch(
+            "rank_llm.rerank.listwise.rank_fid.T5TokenizerFast.from_pretrained",
+            return_value=self.tokenizer,
+        )
+        self.patcher_llm = patch(
+            "rank_llm.rerank.listwise.rank_fid.FiD.from_pretrained",
+            return_value=self.llm,
+        )
+        self.patcher_tokenizer.start()
+        self.patcher_llm.start()
+
+        # passages of different lengths, so some of them are padded
+        self.batch_prompts = [
+            [
+                f"Search Query: q Passage: [{i + 1}] "
+                + " ".join(f"p{j}" for j in range(i + b))
+                + " Relevance Ranking: "
+                for i in range(3)
+            ]
+            for b in range(1, 3)
+        ]
+
+    def tearDown(self):
+        self.patcher_tokenizer.stop()
+        self.patcher_llm.stop()
+
+    def _model(self, **kwargs) -> RankFiDDistill:
+        return RankFiDDistill(
+            reorder_policy=MagicMock(),
+            model="castorini/LiT5-Distill-base",
+            precision="float32",
+            device="cpu",
+            **kwargs,
+        )
+
+    def _reference_outputs(self, model: RankFiDDistill):
+        # plain FiD generate over the padded batch, without precomputed encoder outputs
+        inputs = self.tokenizer(
+            [prompt for prompts in self.batch_prompts for prompt in prompts],
+            padding="longest",
+            truncation=True,
+            max_length=model.max_tokens(),
+            return_tensors="pt",
+        )
+        outputs = self.llm.generate(
+            input_ids=inputs["input_ids"].reshape(len(self.batch_prompts), -1),
+            attention_mask=inputs["attention_mask"].reshape(
+                len(self.batch_prompts), -1
+            ),
+            max_length=model._answer_maxlength,
+            do_sample=False,
+            n_passages=3,
+        )
+        return [
+            (self.tokenizer.decode(output, skip_special_tokens=True), outputs.shape[1])
+            for output in outputs
+        ]
+
+    def test_encode_passages(self):
+        model = self._model()
+        tokenized = _batch_input_ids(
+            self.tokenizer,
+            [
+                self.tokenizer.encode(prompt)
+                for prompts in self.batch_prompts
+                for prompt in prompts
+            ],
+            model.max_tokens(),
+        )
+        with torch.inference_mode():
+            states = model._encode_passages(
+                tokenized["input_ids"], tokenized["attention_mask"], 2
+            ).last_hidden_state
+            expected = self.llm.encoder(
+                input_ids=tokenized["input_ids"].reshape(2, -1),
+                attention_mask=tokenized["attention_mask"].reshape(2, -1),
+                n_passages=3,
+                return_dict=True,
+            ).last_hidden_state
+        # padded positions are masked out in the cross attention
+        mask = tokenized["attention_mask"].reshape(2, -1).bool()
+        self.assertEqual(states.shape, expected.shape)
+        self.assertTrue(torch.allclose(states[mask], expected[mask], atol=1e-5))
+        self.assertTrue(torch.all(states[~mask] == 0))
+
+    def _count_encoded(self):
+        # number of passages in each encoder call
+        n_encoded = []
+        hook = self.llm.encoder.register_forward_pre_hook(
+            lambda module, args, kwargs: n_encoded.append(
+                kwargs["input_ids"].shape[0] * kwargs["n_passages"]
+            ),
+            with_kwargs=True,
+        )
+        return n_encoded, hook
+
+    def test_generate_without_cache(self):
+        # with the cache off, generate runs the FiD encoder over the batch itself
+        model = self._model()
+        n_encoded, hook = self._count_encoded()
+        outputs = model._run_llm_by_length_unified(self.batch_prompts)
+        hook.remove()
+
+        self.assertEqual(outputs, self._reference_outputs(model))
+        self.assertEqual(n_encoded, [6])
+        self.assertEqual(len(model._enc_cache), 0)
+
+    def test_encoder_cache(self):
+        model = self._model(encoder_cache_size=4)
+        n_encoded, hook = self._count_encoded()
+        first = model._run_llm_by_length_unified(self.batch_prompts)
+        second = model._run_llm_by_length_unified(self.batch_prompts)
+        hook.remove()
+
+        self.assertEqual(first, self._reference_outputs(model))
+        self.assertEqual(second, first)
+        # 6 passages, 4 cached: the oldest 2 are encoded again
+        self.assertEqual(n_encoded, [6, 2])
+        self.assertEqual(len(model._enc_cache), 4)
+        # cached states own their memory instead of viewing the encoder batch
+        for hidden in model._enc_cache.values():
+            self.assertEqual(
+                hidden.untyped_storage().nbytes(),
+                hidden.numel() * hidden.element_size(),
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import random
+import unittest
+
+from rank_llm.rerank.listwise.reorder.tournament_sort_reorder_policy import (
+    multiple_sort,
+)
+
+# n_passage, window_size, r, top_k
+valid_inputs = [
+    (100, 20, 1, 10),
+    (100, 20, 2, 10),
+    (50, 10, 1, 20),
+    (30, 20, 1, 10),
+    (7, 4, 1, 3),
+]
+
+
+class TestTournamentSorter(unittest.TestCase):
+    def setUp(self):
+        self.n_call = 0
+        self.n_round = 0
+        self.top_ks = []
+        self.sizes = []
+
+    def _sort(self, n_passage, window_size, r, top_k, seed=0, batch_size=3):
+        rnd = random.Random(seed)
+        scores = [[rnd.random() for _ in range(n_passage)] for _ in range(batch_size)]
+
+        def runner(reqs, top_k=None):
+            self.n_call += len(reqs)
+            self.n_round += len(reqs) > 0
+            self.top_ks.append(top_k)
+            self.sizes.extend(len(indices) for _, indices in reqs)
+            perms = [
+                sorted(range(len(indices)), key=lambda i: -scores[q][indices[i]])
+                for q, indices in reqs
+            ]
+            # positions after top_k are not ranked, they keep the input order
+            if top_k is not None:
+                perms = [perm[:top_k] + sorted(perm[top_k:]) for perm in perms]
+            return perms
+
+        results = multiple_sort(
+            list(range(batch_size)),
+            [list(range(n_passage)) for _ in range(batch_size)],
+            runner=runner,
+            window_size=window_size,
+            r=r,
+            top_k=top_k,
+        )
+        expected = [
+            sorted(range(n_passage), key=lambda i: -score[i])[:top_k]
+            for score in scores
+        ]
+        return results, expected
+
+    def test_top_k_order(self):
+        for n_passage, window_size, r, top_k in valid_inputs:
+            results, expected = self._sort(n_passage, window_size, r, top_k)
+            for result, exp in zip(results, expected):
+                self.assertEqual(result[:top_k], exp)
+                self.assertEqual(sorted(result), list(range(n_passage)))
+
+    def test_pop_replays_losers(self):
+        # 100 passages, window 20: 5 leaf groups under one root. Each pop only needs to
+        #   replay the root, leaf groups reuse their stored losers
+        self._sort(100, 20, 1, 10, batch_size=1)
+        self.assertEqual(self.n_call, 6 + 10)
+        # the root replays the new leaf group champion against its best loser only, or falls
+        #   back to a full (padded) resort when it has no loser left
+        self.assertIn(2, self.sizes[6:])
+        self.assertTrue(all(size in (2, 20) for size in self.sizes[6:]))
+
+    def test_first_round_batched(self):
+        # the 5 leaf groups are independent and go to the model in a single round
+        self._sort(100, 20, 1, 10, batch_size=1)
+        self.assertEqual(self.n_round, 2 + 10)
+
+    def test_single_candidate_skipped(self):
+        # group (0 1 2 3) and leaf 4 under the root, once a side runs out the root has a
+        #   single candidate left and needs no model call
+        self._sort(5, 4, 1, 5, batch_size=1)
+        self.assertEqual(self.n_call, 4)
+
+    def test_top_k_requested(self):
+        # leaf groups are popped at most 10 times and need 1 top after that
+        self._sort(100, 20, 1, 10, batch_size=1)
+        self.assertEqual(self.top_ks[0], 11)
+        self.assertTrue(all(k is None or k <= 20 for k in self.top_ks))
+
+
+if __name__ == "__main__":
+    unittest.main()